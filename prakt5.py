@@ -1,56 +1,174 @@
-from flask import Flask, request, jsonify
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import orjson
+from flask import Flask, Response, g, has_app_context, request, jsonify, make_response
 from flask_restful import Api, Resource
+from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
-from marshmallow import Schema, fields, ValidationError
+from sqlalchemy import select, delete, event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload, raiseload
+from werkzeug.http import generate_etag
+from marshmallow import Schema, fields, validate, ValidationError, EXCLUDE
 from flask_jwt_extended import (
     JWTManager, create_access_token, jwt_required
 )
-from werkzeug.security import generate_password_hash, check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from werkzeug.security import check_password_hash
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///db.sqlite3"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "pool_pre_ping": True,
+    "connect_args": {"check_same_thread": False, "timeout": 30},
+}
+app.config["CACHE_TYPE"] = "SimpleCache"
+app.config["CACHE_DEFAULT_TIMEOUT"] = 60
+app.config["SQL_COUNT_DEBUG"] = False
+app.config["SQL_COUNT_THRESHOLD"] = 5
 app.config["JWT_SECRET_KEY"] = "super-secret-key"
+# Flask-RESTful only hands flask_jwt_extended errors to their handlers when
+# exceptions propagate; debug mode used to turn this on implicitly.
+app.config["PROPAGATE_EXCEPTIONS"] = True
+app.config["PASSWORD_HASH_TARGET_SECONDS"] = 0.1
+app.config["JWT_DECODE_CACHE_SIZE"] = 4096
 
 db = SQLAlchemy(app)
 api = Api(app)
+cache = Cache(app)
+
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    resp = make_response(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS) + b"\n", code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = "application/json"
+    return resp
+
+# Bumped on every write; cache entries carry the generation they were built
+# in. Kept in the process rather than in the cache so eviction cannot reset it.
+list_generation = 0
+list_generation_lock = threading.Lock()
+
+def cached_list(key, args_schema=None):
+    """Serve a list endpoint from the cache, answering 304 on a matching ETag.
+
+    Entries are keyed by the current list generation and, when args_schema is
+    given, by the validated query args, which are passed to the view as
+    ``query_args``. Any other query string is ignored.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            entry_key = f"{key}:{list_generation}"
+            if args_schema is not None:
+                try:
+                    query_args = args_schema.load(request.args)
+                except ValidationError as err:
+                    return output_json(err.messages, 400)
+                kwargs["query_args"] = query_args
+                entry_key += "".join(f":{name}={query_args[name]}" for name in sorted(query_args))
+
+            entry = cache.get(entry_key)
+            if entry is None:
+                resp = view(*args, **kwargs)
+                if not isinstance(resp, Response):
+                    resp = output_json(*resp)
+                if resp.status_code != 200:
+                    return resp
+                body = resp.get_data()
+                entry = (body, generate_etag(body))
+                cache.set(entry_key, entry)
+
+            body, etag = entry
+            if request.if_none_match.contains_weak(etag):
+                resp = Response(status=304)
+            else:
+                resp = Response(body, mimetype="application/json")
+            resp.set_etag(etag)
+            return resp
+        return wrapper
+    return decorator
+
+def invalidate_list_cache():
+    global list_generation
+    with list_generation_lock:
+        list_generation += 1
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_sql_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and "sql_query_count" in g:
+        g.sql_query_count += 1
+
+@app.before_request
+def start_sql_query_count():
+    if app.config["SQL_COUNT_DEBUG"]:
+        g.sql_query_count = 0
+
+@app.after_request
+def report_sql_query_count(response):
+    if "sql_query_count" in g:
+        response.headers["X-SQL-Query-Count"] = str(g.sql_query_count)
+        if g.sql_query_count > app.config["SQL_COUNT_THRESHOLD"]:
+            app.logger.warning(
+                "%s %s ran %d SQL queries",
+                request.method, request.path, g.sql_query_count,
+            )
+    return response
 
 product_tags = db.Table(
     "product_tags",
     db.Column("product_id", db.Integer, db.ForeignKey("products.id"), primary_key=True),
     db.Column("tag_id",     db.Integer, db.ForeignKey("tags.id"),     primary_key=True),
 )
+db.Index("ix_product_tags_tag_product", product_tags.c.tag_id, product_tags.c.product_id)
 
 class User(db.Model):
     __tablename__ = "users"
     id       = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
+    username = db.Column(db.String(80), unique=True, index=True, nullable=False)
     password = db.Column(db.String(128), nullable=False)
 
 class Product(db.Model):
     __tablename__ = "products"
     id      = db.Column(db.Integer, primary_key=True)
-    title   = db.Column(db.String(80), unique=True, nullable=False)
+    title   = db.Column(db.String(80), unique=True, index=True, nullable=False)
     cost    = db.Column(db.Float, nullable=False)
-    shop_id = db.Column(db.Integer, db.ForeignKey("shops.id"), nullable=False)
+    shop_id = db.Column(db.Integer, db.ForeignKey("shops.id"), index=True, nullable=False)
     shop    = db.relationship("Shop", back_populates="products")
     tags    = db.relationship(
         "Tag",
         secondary=product_tags,
         back_populates="products",
-        lazy="dynamic"
+        lazy="selectin"
     )
 
 class Shop(db.Model):
     __tablename__ = "shops"
     id       = db.Column(db.Integer, primary_key=True)
-    title    = db.Column(db.String(80), unique=True, nullable=False)
-    products = db.relationship("Product", back_populates="shop", lazy="dynamic")
+    title    = db.Column(db.String(80), unique=True, index=True, nullable=False)
+    products = db.relationship("Product", back_populates="shop", lazy="select")
 
 class Tag(db.Model):
     __tablename__ = "tags"
     id       = db.Column(db.Integer, primary_key=True)
-    name     = db.Column(db.String(50), unique=True, nullable=False)
+    name     = db.Column(db.String(50), unique=True, index=True, nullable=False)
     products = db.relationship(
         "Product",
         secondary=product_tags,
@@ -62,6 +180,132 @@ class UserSchema(Schema):
     username = fields.Str(required=True)
     password = fields.Str(required=True, load_only=True)
 
+class ShopRollup(db.Model):
+    __tablename__ = "shop_rollups"
+    shop_id       = db.Column(db.Integer, primary_key=True)
+    title         = db.Column(db.String(80), nullable=False)
+    product_count = db.Column(db.Integer, nullable=False, default=0)
+    min_cost      = db.Column(db.Float)
+    max_cost      = db.Column(db.Float)
+    top_products  = db.Column(db.JSON, nullable=False, default=list)
+
+ROLLUP_TOP_PRODUCTS = 5
+SHOPS_YIELD_PER = 200
+
+ROLLUP_RESCAN_SQL = text("""
+    INSERT OR REPLACE INTO shop_rollups
+        (shop_id, title, product_count, min_cost, max_cost, top_products)
+    SELECT s.id, s.title, count(p.id), min(p.cost), max(p.cost), (
+        SELECT json_group_array(json_object('title', t.title, 'cost', t.cost))
+        FROM (SELECT title, cost FROM products
+              WHERE shop_id = s.id
+              ORDER BY cost DESC
+              LIMIT :top) AS t
+    )
+    FROM shops s LEFT JOIN products p ON p.shop_id = s.id
+    WHERE s.id = :shop_id
+    GROUP BY s.id
+""")
+
+ROLLUP_ADD_SQL = text("""
+    UPDATE shop_rollups SET
+        product_count = product_count + :count,
+        min_cost = min(coalesce(min_cost, :min_cost), :min_cost),
+        max_cost = max(coalesce(max_cost, :max_cost), :max_cost),
+        top_products = (
+            SELECT json_group_array(json(value)) FROM (
+                SELECT value FROM (
+                    SELECT value FROM json_each(shop_rollups.top_products)
+                    UNION ALL
+                    SELECT value FROM json_each(:added)
+                )
+                ORDER BY json_extract(value, '$.cost') DESC
+                LIMIT :top
+            )
+        )
+    WHERE shop_id = :shop_id
+""")
+
+ROLLUP_REMOVE_SQL = text("""
+    UPDATE shop_rollups SET product_count = product_count - 1
+    WHERE shop_id = :shop_id
+      AND :cost > min_cost AND :cost < max_cost
+      AND NOT EXISTS (SELECT 1 FROM json_each(top_products)
+                      WHERE json_extract(value, '$.title') = :title)
+""")
+
+def rescan_shop_rollup(connection, shop_id):
+    """Recompute the rollup row of one shop from the products table."""
+    params = {"shop_id": shop_id, "top": ROLLUP_TOP_PRODUCTS}
+    if not connection.execute(ROLLUP_RESCAN_SQL, params).rowcount:
+        rollups = ShopRollup.__table__
+        connection.execute(delete(rollups).where(rollups.c.shop_id == shop_id))
+
+@event.listens_for(Session, "after_flush")
+def update_shop_rollups(session, flush_context):
+    """Apply the product changes of one flush to the rollup table.
+
+    New products are merged into the stored count, cost range and top list
+    with a single UPDATE per shop. A shop is rescanned only when that is not
+    possible: the shop itself was added or deleted, a product was edited, a
+    removed product held the min, the max or a top slot, or the shop has no
+    rollup row yet.
+    """
+    connection = session.connection()
+    rescan = set()
+    added = defaultdict(list)
+    for obj in session.new:
+        if isinstance(obj, Shop):
+            rescan.add(obj.id)
+        elif isinstance(obj, Product):
+            added[obj.shop_id].append(obj)
+    for obj in session.deleted:
+        if isinstance(obj, Shop):
+            rescan.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Product):
+            attrs = inspect(obj).attrs
+            if any(attrs[key].history.has_changes() for key in ("title", "cost", "shop_id")):
+                rescan.add(obj.shop_id)
+                rescan.update(attrs.shop_id.history.deleted)
+
+    for obj in session.deleted:
+        if isinstance(obj, Product) and obj.shop_id not in rescan:
+            params = {"shop_id": obj.shop_id, "cost": obj.cost, "title": obj.title}
+            if not connection.execute(ROLLUP_REMOVE_SQL, params).rowcount:
+                rescan.add(obj.shop_id)
+
+    for shop_id, products in added.items():
+        if shop_id in rescan:
+            continue
+        costs = [p.cost for p in products]
+        top = sorted(products, key=lambda p: p.cost, reverse=True)[:ROLLUP_TOP_PRODUCTS]
+        params = {
+            "shop_id": shop_id,
+            "count": len(products),
+            "min_cost": min(costs),
+            "max_cost": max(costs),
+            "added": orjson.dumps([{"title": p.title, "cost": p.cost} for p in top]).decode(),
+            "top": ROLLUP_TOP_PRODUCTS,
+        }
+        if not connection.execute(ROLLUP_ADD_SQL, params).rowcount:
+            rescan.add(shop_id)
+
+    for shop_id in rescan:
+        rescan_shop_rollup(connection, shop_id)
+
+@app.cli.command("refresh-views")
+def refresh_views():
+    """Rebuild the shop rollup table from the products table.
+
+    This runs in its own process, so a running server keeps serving its
+    cached /shops/summary until that cache entry times out.
+    """
+    with db.engine.begin() as connection:
+        connection.execute(delete(ShopRollup.__table__))
+        for shop_id in connection.scalars(select(Shop.id)).all():
+            rescan_shop_rollup(connection, shop_id)
+
 class ShopSummarySchema(Schema):
     id    = fields.Int(dump_only=True)
     title = fields.Str(required=True)
@@ -74,23 +318,118 @@ class ProductSchema(Schema):
     id      = fields.Int(dump_only=True)
     title   = fields.Str(required=True)
     cost    = fields.Float(required=True)
-    shop_id = fields.Int(load_only=True, required=True)
-    tag_ids = fields.List(fields.Int(), load_only=True)
     shop    = fields.Nested(ShopSummarySchema, dump_only=True)
     tags    = fields.List(fields.Nested(TagSchema), dump_only=True)
 
 class ShopSchema(ShopSummarySchema):
     products = fields.List(fields.Nested(ProductSchema), dump_only=True)
 
+class ProductCreateSchema(Schema):
+    title   = fields.Str(required=True)
+    cost    = fields.Float(required=True)
+    shop_id = fields.Int(required=True)
+    tag_ids = fields.List(fields.Int())
+
+class ShopCreateSchema(Schema):
+    title = fields.Str(required=True)
+
+class TagCreateSchema(Schema):
+    name = fields.Str(required=True)
+
+class ShopRollupSchema(Schema):
+    shop_id       = fields.Int(dump_only=True)
+    title         = fields.Str(dump_only=True)
+    product_count = fields.Int(dump_only=True)
+    min_cost      = fields.Float(dump_only=True)
+    max_cost      = fields.Float(dump_only=True)
+    top_products  = fields.Function(lambda rollup: [p["title"] for p in rollup.top_products])
+
+class PageArgsSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    after = fields.Int(load_default=0, validate=validate.Range(min=0, max=2**63 - 1))
+    limit = fields.Int(load_default=100, validate=validate.Range(min=1, max=500))
+
 user_schema     = UserSchema()
 product_schema  = ProductSchema()
 products_schema = ProductSchema(many=True)
 shop_schema     = ShopSchema()
 shops_schema    = ShopSchema(many=True)
+rollups_schema  = ShopRollupSchema(many=True)
 tag_schema      = TagSchema()
 tags_schema     = TagSchema(many=True)
 
-jwt = JWTManager(app)
+product_create_schema = ProductCreateSchema()
+shop_create_schema    = ShopCreateSchema()
+tag_create_schema     = TagCreateSchema()
+page_args_schema      = PageArgsSchema()
+
+class CachingJWTManager(JWTManager):
+    """JWTManager that skips signature checks for tokens it already verified.
+
+    Verified claims are kept in a per-process LRU keyed by a blake2b digest
+    of the encoded token and are dropped once the token's ``exp`` passes.
+    """
+
+    def __init__(self, app=None, **kwargs):
+        self._verified = OrderedDict()
+        self._verified_lock = threading.Lock()
+        super().__init__(app, **kwargs)
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        if csrf_value is not None or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+        key = hashlib.blake2b(encoded_token.encode(), digest_size=16).digest()
+        with self._verified_lock:
+            claims = self._verified.get(key)
+            if claims is not None:
+                if claims.get("exp", float("inf")) > time.time():
+                    self._verified.move_to_end(key)
+                    return claims
+                del self._verified[key]
+
+        claims = super()._decode_jwt_from_config(encoded_token)
+        with self._verified_lock:
+            self._verified[key] = claims
+            if len(self._verified) > app.config["JWT_DECODE_CACHE_SIZE"]:
+                self._verified.popitem(last=False)
+        return claims
+
+jwt = CachingJWTManager(app)
+
+def calibrated_password_hasher(target_seconds, memory_cost=65536):
+    """Build an argon2id hasher that takes about target_seconds per hash.
+
+    A probe at time_cost=1 measures this host. The time cost is raised to
+    reach the target; if one pass is already slower, the memory cost is
+    lowered instead, but not below 19 MiB.
+    """
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        PasswordHasher(time_cost=1, memory_cost=memory_cost).hash("calibration")
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    if elapsed > target_seconds:
+        memory_cost = max(19456, int(memory_cost * target_seconds / elapsed))
+    time_cost = max(1, round(target_seconds / elapsed))
+    return PasswordHasher(time_cost=time_cost, memory_cost=memory_cost)
+
+password_hasher = calibrated_password_hasher(app.config["PASSWORD_HASH_TARGET_SECONDS"])
+
+def is_argon2_hash(stored_hash):
+    return stored_hash.startswith("$argon2")
+
+def verify_password(stored_hash, password):
+    """Check a password against an argon2 hash or a legacy werkzeug hash."""
+    if not is_argon2_hash(stored_hash):
+        return check_password_hash(stored_hash, password)
+    try:
+        return password_hasher.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
 
 @jwt.unauthorized_loader
 def missing_token(error):
@@ -104,15 +443,16 @@ class RegisterResource(Resource):
         except ValidationError as err:
             return err.messages, 400
 
-        if User.query.filter_by(username=data["username"]).first():
-            return {"message": "Username already exists"}, 409
-
         new_user = User(
             username=data["username"],
-            password=generate_password_hash(data["password"])
+            password=password_hasher.hash(data["password"])
         )
-        db.session.add(new_user)
-        db.session.commit()
+        try:
+            db.session.add(new_user)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return {"message": "Username already exists"}, 409
         return {"message": "User registered"}, 201
 
 class LoginResource(Resource):
@@ -124,9 +464,13 @@ class LoginResource(Resource):
             return err.messages, 400
 
         user = User.query.filter_by(username=data["username"]).first()
-        if not user or not check_password_hash(user.password, data["password"]):
+        if not user or not verify_password(user.password, data["password"]):
             return {"message": "Invalid credentials"}, 401
 
+        if not is_argon2_hash(user.password):
+            user.password = password_hasher.hash(data["password"])
+            db.session.commit()
+
         access_token = create_access_token(identity=user.id)
         return {"access_token": access_token}, 200
 
@@ -145,31 +489,54 @@ class ProductResource(ProtectedResource):
         if prod:
             db.session.delete(prod)
             db.session.commit()
+            invalidate_list_cache()
         return {"message": "Product deleted"}, 200
 
+PRODUCTS_JSON_SQL = text("""
+    SELECT json_object('items', json_group_array(json_object(
+        'id', p.id,
+        'title', p.title,
+        'cost', p.cost,
+        'shop', CASE WHEN s.id IS NULL THEN NULL
+                     ELSE json_object('id', s.id, 'title', s.title) END,
+        'tags', json((
+            SELECT json_group_array(json_object('id', t.id, 'name', t.name))
+            FROM (SELECT t.id, t.name
+                  FROM product_tags pt JOIN tags t ON t.id = pt.tag_id
+                  WHERE pt.product_id = p.id
+                  ORDER BY t.id) AS t
+        ))
+    )) FILTER (WHERE p.id IS NOT NULL),
+    'next', CASE WHEN count(p.id) = :limit THEN max(p.id) END)
+    FROM (SELECT * FROM products WHERE id > :after ORDER BY id LIMIT :limit) AS p
+    LEFT JOIN shops s ON s.id = p.shop_id
+""")
+
 class ProductListResource(ProtectedResource):
-    def get(self):
-        return products_schema.dump(Product.query.all()), 200
+    @cached_list("products_list", page_args_schema)
+    def get(self, query_args):
+        sql_json = db.session.execute(PRODUCTS_JSON_SQL, query_args).scalar()
+        return Response(sql_json + "\n", mimetype="application/json")
 
     def post(self):
         json_data = request.get_json() or {}
         try:
-            data = product_schema.load(json_data)
+            data = product_create_schema.load(json_data)
         except ValidationError as err:
             return err.messages, 400
 
-        if Product.query.filter_by(title=data["title"]).first():
-            return {"message": "Product already exists"}, 400
-
         tag_ids = data.pop("tag_ids", [])
         new_prod = Product(**data)
-        for tid in tag_ids:
-            tag = Tag.query.get(tid)
-            if tag:
-                new_prod.tags.append(tag)
+        if tag_ids:
+            new_prod.tags.extend(Tag.query.filter(Tag.id.in_(tag_ids)).all())
 
-        db.session.add(new_prod)
-        db.session.commit()
+        try:
+            db.session.add(new_prod)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return {"message": "Product already exists"}, 400
+        invalidate_list_cache()
         return product_schema.dump(new_prod), 201
 
 class ShopResource(ProtectedResource):
@@ -184,27 +551,50 @@ class ShopResource(ProtectedResource):
         if shop:
             db.session.delete(shop)
             db.session.commit()
+            invalidate_list_cache()
         return {"message": "Shop deleted"}, 200
 
 class ShopListResource(ProtectedResource):
+    @cached_list("shops_list")
     def get(self):
-        return shops_schema.dump(Shop.query.all()), 200
+        stmt = (
+            select(Shop)
+            .options(
+                selectinload(Shop.products).selectinload(Product.tags),
+                selectinload(Shop.products).joinedload(Product.shop),
+                raiseload("*"),
+            )
+            .order_by(Shop.id)
+            .execution_options(yield_per=SHOPS_YIELD_PER)
+        )
+        # Shops are fetched in batches of SHOPS_YIELD_PER; each batch runs
+        # its own IN-batched selectin queries for products and tags.
+        with db.session.no_autoflush:
+            return shops_schema.dump(db.session.scalars(stmt)), 200
 
     def post(self):
         json_data = request.get_json() or {}
         try:
-            data = shop_schema.load(json_data)
+            data = shop_create_schema.load(json_data)
         except ValidationError as err:
             return err.messages, 400
 
-        if Shop.query.filter_by(title=data["title"]).first():
-            return {"message": "Shop already exists"}, 400
-
         new_shop = Shop(**data)
-        db.session.add(new_shop)
-        db.session.commit()
+        try:
+            db.session.add(new_shop)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return {"message": "Shop already exists"}, 400
+        invalidate_list_cache()
         return shop_schema.dump(new_shop), 201
 
+class ShopRollupListResource(ProtectedResource):
+    @cached_list("shop_rollups_list")
+    def get(self):
+        rollups = db.session.scalars(select(ShopRollup)).all()
+        return rollups_schema.dump(rollups), 200
+
 class TagResource(ProtectedResource):
     def get(self, name):
         tag = Tag.query.filter_by(name=name).first()
@@ -217,42 +607,63 @@ class TagResource(ProtectedResource):
         if tag:
             db.session.delete(tag)
             db.session.commit()
+            invalidate_list_cache()
         return {"message": "Tag deleted"}, 200
 
 class TagListResource(ProtectedResource):
+    @cached_list("tags_list")
     def get(self):
-        return tags_schema.dump(Tag.query.all()), 200
+        stmt = select(Tag).options(raiseload("*"))
+        return tags_schema.dump(db.session.scalars(stmt).all()), 200
 
     def post(self):
         json_data = request.get_json() or {}
         try:
-            data = tag_schema.load(json_data)
+            data = tag_create_schema.load(json_data)
         except ValidationError as err:
             return err.messages, 400
 
-        if Tag.query.filter_by(name=data["name"]).first():
-            return {"message": "Tag already exists"}, 400
-
         new_tag = Tag(**data)
-        db.session.add(new_tag)
-        db.session.commit()
+        try:
+            db.session.add(new_tag)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return {"message": "Tag already exists"}, 400
+        invalidate_list_cache()
         return tag_schema.dump(new_tag), 201
 
 class ProductTagLinkResource(ProtectedResource):
     def post(self, title, tag_id):
-        prod = Product.query.filter_by(title=title).first_or_404()
-        tag  = Tag.query.get_or_404(tag_id)
-        if not prod.tags.filter_by(id=tag_id).first():
-            prod.tags.append(tag)
-            db.session.commit()
+        link = product_tags.insert().prefix_with("OR IGNORE").from_select(
+            ["product_id", "tag_id"],
+            select(Product.id, Tag.id)
+            .join(Tag, Tag.id == tag_id)
+            .where(Product.title == title),
+        )
+        result = db.session.execute(link)
+        db.session.commit()
+        if result.rowcount:
+            invalidate_list_cache()
+        else:
+            # Nothing inserted: either already linked or one side is missing.
+            Product.query.filter_by(title=title).first_or_404()
+            db.get_or_404(Tag, tag_id)
         return {"message": "Tag linked to product"}, 200
 
     def delete(self, title, tag_id):
-        prod = Product.query.filter_by(title=title).first_or_404()
-        tag  = Tag.query.get_or_404(tag_id)
-        if prod.tags.filter_by(id=tag_id).first():
-            prod.tags.remove(tag)
-            db.session.commit()
+        product_id = select(Product.id).where(Product.title == title).scalar_subquery()
+        unlink = product_tags.delete().where(
+            product_tags.c.product_id == product_id,
+            product_tags.c.tag_id == tag_id,
+        )
+        result = db.session.execute(unlink)
+        db.session.commit()
+        if result.rowcount:
+            invalidate_list_cache()
+        else:
+            Product.query.filter_by(title=title).first_or_404()
+            db.get_or_404(Tag, tag_id)
         return {"message": "Tag unlinked from product"}, 200
 
 api.add_resource(RegisterResource,      "/register")
@@ -261,12 +672,19 @@ api.add_resource(ProductResource,       "/product/<string:title>")
 api.add_resource(ProductListResource,   "/products")
 api.add_resource(ShopResource,          "/shop/<string:title>")
 api.add_resource(ShopListResource,      "/shops")
+api.add_resource(ShopRollupListResource,"/shops/summary")
 api.add_resource(TagResource,           "/tag/<string:name>")
 api.add_resource(TagListResource,       "/tags")
 api.add_resource(ProductTagLinkResource,"/product/<string:title>/tags/<int:tag_id>")
 
 if __name__ == "__main__":
+    # The Werkzeug debug server is for development only; serve through waitress
+    # instead, or run `gunicorn -w 1 -k gthread --threads 8 prakt5:app`. Keep to
+    # one process: the list cache and its invalidation live in the process, so
+    # extra workers would keep serving stale lists after another's writes.
+    from waitress import serve
+
     with app.app_context():
         db.create_all()
-    app.run(debug=True)
+    serve(app, threads=8)
     
\ No newline at end of file